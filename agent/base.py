@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import os
+import shlex
 import subprocess
 import traceback
 from datetime import datetime
@@ -45,7 +46,12 @@ class Base:
         directory = directory or self.directory
         start = datetime.now()
         self.skip_output_log = skip_output_log
-        self.data = get_execution_result(command, directory, start)
+        # Commands can be an argv list, which runs without a shell in between
+        self.data = get_execution_result(
+            command if isinstance(command, str) else shlex.join(command),
+            directory,
+            start,
+        )
         self.log()
         output = ""
         try:
@@ -89,7 +95,7 @@ class Base:
             stderr=subprocess.STDOUT,
             stdin=subprocess.PIPE if input else None,
             cwd=directory,
-            shell=True,
+            shell=isinstance(command, str),
             executable=executable,
         ) as process:
             if input:
@@ -448,11 +448,11 @@ class Bench(Base):
 
     @step("Bench Setup NGINX Target")
     def setup_nginx_target(self):
+        # Callers reload nginx in a step of their own right after this
         from filelock import FileLock
 
         with FileLock(os.path.join(self.directory, "nginx.config.lock")):
             self.generate_nginx_config()
-        return self.server._reload_nginx()
 
     def _set_sites_host(self, sites: list[Site]):
         for site in sites:
@@ -95,12 +95,12 @@ def sentry(sentry_dsn):
 
 @setup.command()
 def supervisor():
-    Server().setup_supervisor()
+    Server().setup_supervisor(update=True)
 
 
 @setup.command()
 def nginx():
-    Server().setup_nginx()
+    Server().setup_nginx(reload=True)
 
 
 @setup.command()
@@ -502,6 +502,41 @@ WHERE
             if record["db"] == self.database_name
         ]
 
+    def optimize_tables(self, tables: list[str]) -> dict:
+        """
+        Optimize tables over a single connection
+
+        OPTIMIZE TABLE accepts a list of tables, so they are sent in batches
+        instead of one statement each.
+
+        Return Format:
+        {
+            "optimized_tables": ["tabUser", ...],
+            "failed_optimizations": {
+                "tabNote": "Table 'db.tabNote' doesn't exist",
+                ...
+            },
+        }
+        """
+        if not tables:
+            return {"optimized_tables": [], "failed_optimizations": {}}
+        queries = [
+            "OPTIMIZE TABLE " + ", ".join(f"`{table.replace('`', '``')}`" for table in batch)
+            for batch in (tables[index : index + 50] for index in range(0, len(tables), 50))
+        ]
+        result = self._run_sql(";\n".join(queries), commit=True, as_dict=True)
+        # Each table gets one or more rows (note, status, error, ...), named as <database>.<table>
+        reported_tables, failed_optimizations = {}, {}
+        for row in (row for query in result for row in query["output"]):
+            table = row["Table"].split(".", 1)[-1]
+            reported_tables[table] = True
+            if row["Msg_type"].lower() == "error":
+                failed_optimizations.setdefault(table, row["Msg_text"])
+        return {
+            "optimized_tables": [table for table in reported_tables if table not in failed_optimizations],
+            "failed_optimizations": failed_optimizations,
+        }
+
     def kill_process(self, pid: str):
         with contextlib.suppress(Exception):
             processes = self.fetch_process_list()
@@ -1,17 +1,22 @@
 from __future__ import annotations
 
 import json
+import math
 import os
 import platform
+import pwd
+import re
 import shutil
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 from datetime import datetime
+from functools import lru_cache
 
-from jinja2 import Environment, PackageLoader
-from passlib.hash import pbkdf2_sha256 as pbkdf2
-from peewee import MySQLDatabase
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader
+from peewee import InterfaceError, MySQLDatabase, OperationalError
 
 from agent.base import AgentException, Base
 from agent.bench import Bench
@@ -19,19 +24,45 @@ from agent.exceptions import BenchNotExistsException
 from agent.job import Job, Step, job, step
 from agent.patch_handler import run_patches
 from agent.site import Site
+from agent.utils import end_execution, get_execution_result, move
+
+# <name>[:<group>]   <state>   <description>, one process per line
+SUPERVISOR_STATUS_PATTERN = re.compile(
+    r"^(?P<name>[^\s:]*)(?::(?P<group>[^\s:]*))?\S*[ \t]+(?P<state>\S+)[ \t]*(?P<description>.*?)[ \t]*$",
+    re.MULTILINE,
+)
+
+# MariaDB root password -> connection used by mariadb_processlist, holds at most one entry.
+# The connection isn't thread local, status polls from any thread share it under the lock.
+MARIADB_CONNECTIONS = {}
+MARIADB_LOCK = threading.Lock()
+
+# Repository directory -> ((HEAD commit, .git/config mtime), git output that only depends on them)
+AGENT_VERSION_CACHE = {}
+
+# Names of temporary files and directories left behind by PDF generation, snyk, yarn and uploads
+TEMPORARY_FILE_PATTERN = re.compile(r"frappe-pdf|snyk-patch|yarn-|agent-upload")
+
+# Last /proc/stat reading with its monotonic timestamp, the baseline for the next usage figure
+CPU_SAMPLE = {}
+
+# Hosts directory -> (directory mtime, wildcard domains found in it)
+WILDCARDS_CACHE = {}
 
 
 class Server(Base):
     def __init__(self, directory=None):
         self.directory = directory or os.getcwd()
         self.config_file = os.path.join(self.directory, "config.json")
-        self.name = self.config["name"]
-        self.benches_directory = self.config["benches_directory"]
+        config = self.config
+        self.name = config["name"]
+        self.benches_directory = config["benches_directory"]
         self.archived_directory = os.path.join(os.path.dirname(self.benches_directory), "archived")
-        self.nginx_directory = self.config["nginx_directory"]
+        self.nginx_directory = config["nginx_directory"]
         self.hosts_directory = os.path.join(self.nginx_directory, "hosts")
 
-        self.error_pages_directory = os.path.join(self.directory, "repo", "agent", "pages")
+        self.repo_directory = os.path.join(self.directory, "repo")
+        self.error_pages_directory = os.path.join(self.repo_directory, "agent", "pages")
         self.job = None
         self.step = None
 
@@ -96,11 +127,7 @@ class Server(Base):
         """
         Throw if container exists
         """
-        try:
-            self.execute(f"""docker ps --filter "name=^{name}$" | grep {name}""")
-        except AgentException:
-            pass  # container does not exist
-        else:
+        if self.execute(["docker", "ps", "--filter", f"name=^{name}$", "--format", "{{.Names}}"])["output"]:
             raise Exception("Container exists")
 
     @job("Archive Bench", priority="low")
@@ -129,57 +156,60 @@ class Server(Base):
         self.remove_unused_docker_artefacts()
 
     def remove_benches_without_container(self, benches: list[str]):
+        # One listing for all benches, matched the same way grep did
+        containers = self.execute(["docker", "ps", "-a"])["output"]
         for bench in benches:
-            try:
-                self.execute(f"docker ps -a | grep {bench}")
-            except AgentException as e:
-                if e.data.returncode:
-                    self.move_to_archived_directory(Bench(bench, self))
+            if bench not in containers:
+                self.move_to_archived_directory(Bench(bench, self))
 
     @step("Remove Archived Benches")
     def remove_archived_benches(self):
-        now = datetime.now().timestamp()
-        removed = []
+        now = time.time()
+        stale = []
         if os.path.exists(self.archived_directory):
-            for bench in os.listdir(self.archived_directory):
-                bench_path = os.path.join(self.archived_directory, bench)
-                if now - os.stat(bench_path).st_mtime > 86400:
-                    removed.append(
-                        {
-                            "bench": bench,
-                            "size": self._get_tree_size(bench_path),
-                        }
-                    )
-                    if os.path.isfile(bench_path):
-                        os.remove(bench_path)
-                    elif os.path.isdir(bench_path):
-                        shutil.rmtree(bench_path)
+            with os.scandir(self.archived_directory) as entries:
+                for entry in entries:
+                    if now - entry.stat().st_mtime > 86400:
+                        stale.append(entry)
+
+        sizes = self._get_tree_sizes([entry.path for entry in stale])
+        removed = []
+        for entry in stale:
+            removed.append({"bench": entry.name, "size": sizes.get(entry.path)})
+            if entry.is_file():
+                os.remove(entry.path)
+            elif entry.is_dir():
+                shutil.rmtree(entry.path)
         return {"benches": removed[:100]}
 
     @step("Remove Temporary Files")
     def remove_temporary_files(self):
         temp_directory = tempfile.gettempdir()
-        now = datetime.now().timestamp()
-        removed = []
-        patterns = ["frappe-pdf", "snyk-patch", "yarn-", "agent-upload"]
+        now = time.time()
+        stale = []
         if os.path.exists(temp_directory):
-            for file in os.listdir(temp_directory):
-                if not list(filter(lambda x: x in file, patterns)):
-                    continue
-                file_path = os.path.join(temp_directory, file)
-                if now - os.stat(file_path).st_mtime > 7200:
-                    removed.append({"file": file, "size": self._get_tree_size(file_path)})
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                    elif os.path.isdir(file_path):
-                        shutil.rmtree(file_path)
+            with os.scandir(temp_directory) as entries:
+                for entry in entries:
+                    if not TEMPORARY_FILE_PATTERN.search(entry.name):
+                        continue
+                    if now - entry.stat().st_mtime > 7200:
+                        stale.append(entry)
+
+        sizes = self._get_tree_sizes([entry.path for entry in stale])
+        removed = []
+        for entry in stale:
+            removed.append({"file": entry.name, "size": sizes.get(entry.path)})
+            if entry.is_file():
+                os.remove(entry.path)
+            elif entry.is_dir():
+                shutil.rmtree(entry.path)
         return {"files": removed[:100]}
 
     @step("Remove Unused Docker Artefacts")
     def remove_unused_docker_artefacts(self):
-        before = self.execute("docker system df -v")["output"].split("\n")
-        prune = self.execute("docker system prune -af")["output"].split("\n")
-        after = self.execute("docker system df -v")["output"].split("\n")
+        before = self.execute(["docker", "system", "df", "-v"])["output"].splitlines()
+        prune = self.execute(["docker", "system", "prune", "-af"])["output"].splitlines()
+        after = self.execute(["docker", "system", "df"])["output"].splitlines()
         return {
             "before": before,
             "prune": prune,
@@ -194,7 +224,7 @@ class Server(Base):
         if os.path.exists(target):
             shutil.rmtree(target)
         bench_directory = os.path.join(self.benches_directory, bench_name)
-        self.execute(f"mv {bench_directory} {self.archived_directory}")
+        move(bench_directory, target)
 
     @job("Update Site Pull", priority="low")
     def update_site_pull_job(self, name, source, target, activate):
@@ -365,10 +395,16 @@ class Server(Base):
                 f"{site.name}-{datetime.now().isoformat()}",
             )
             shutil.move(destination, archived_site_path)
-        shutil.move(site.directory, target.sites_directory)
 
-    def execute(self, command, directory=None, skip_output_log=False):
-        return super().execute(command, directory=directory, skip_output_log=skip_output_log)
+        move(site.directory, destination)
+
+    def execute(self, command, directory=None, skip_output_log=False, non_zero_throw=True):
+        return super().execute(
+            command,
+            directory=directory,
+            skip_output_log=skip_output_log,
+            non_zero_throw=non_zero_throw,
+        )
 
     @job("Reload NGINX")
     def restart_nginx(self):
@@ -383,6 +419,8 @@ class Server(Base):
         return self._update_supervisor()
 
     def setup_authentication(self, password):
+        from passlib.hash import pbkdf2_sha256 as pbkdf2
+
         self.update_config({"access_token": pbkdf2.hash(password)})
 
     def setup_proxysql(self, password):
@@ -393,53 +431,104 @@ class Server(Base):
         config.update(value)
         self.setconfig(config, indent=4)
 
+    def setup_features(self, registry=None, log=None, analytics=None, trace=None, sentry_dsn=None):
+        """
+        Enable multiple features with a single config write
+
+        nginx and supervisor are regenerated at most once, only if a
+        feature that affects them was passed
+        """
+        nginx_features = {"registry": registry, "log": log, "analytics": analytics, "trace": trace}
+        nginx_features = {key: value for key, value in nginx_features.items() if value is not None}
+
+        value = dict(nginx_features)
+        if sentry_dsn is not None:
+            value["sentry_dsn"] = sentry_dsn
+        if not value:
+            return
+
+        self.update_config(value)
+        if nginx_features:
+            self.setup_nginx()
+        if sentry_dsn is not None:
+            self.setup_supervisor()
+
     def setup_registry(self):
-        self.update_config({"registry": True})
-        self.setup_nginx()
+        self.setup_features(registry=True)
 
     def setup_log(self):
-        self.update_config({"log": True})
-        self.setup_nginx()
+        self.setup_features(log=True)
 
     def setup_analytics(self):
-        self.update_config({"analytics": True})
-        self.setup_nginx()
+        self.setup_features(analytics=True)
 
     def setup_trace(self):
-        self.update_config({"trace": True})
-        self.setup_nginx()
+        self.setup_features(trace=True)
 
     def setup_sentry(self, sentry_dsn):
-        self.update_config({"sentry_dsn": sentry_dsn})
-        self.setup_supervisor()
+        self.setup_features(sentry_dsn=sentry_dsn)
 
-    def setup_nginx(self):
-        self._generate_nginx_config()
-        self._generate_agent_nginx_config()
-        self._reload_nginx()
+    def setup_nginx(self, reload=False):
+        # reload=True always reloads, so rerunning setup recovers from an earlier reload that failed
+        nginx_changed = self._generate_nginx_config()
+        agent_nginx_changed = self._generate_agent_nginx_config()
+        if reload or nginx_changed or agent_nginx_changed:
+            self._reload_nginx()
 
-    def setup_supervisor(self):
+    def setup_supervisor(self, update=False):
         self._generate_redis_config()
-        self._generate_supervisor_config()
-        self._update_supervisor()
+        # redis.conf is read by redis on restart, only supervisor.conf changes need an update.
+        # update=True always runs it, so rerunning setup recovers from an earlier update that failed
+        if self._generate_supervisor_config() or update:
+            self._update_supervisor()
 
     def start_all_benches(self):
-        for bench in self.benches.values():
-            with suppress(Exception):
-                bench.start()
+        self._run_on_all_benches(lambda bench: bench.start())
 
     def stop_all_benches(self):
-        for bench in self.benches.values():
+        self._run_on_all_benches(lambda bench: bench.stop())
+
+    def _run_on_all_benches(self, action):
+        """
+        Run action on every bench at once, ignoring failures
+
+        Each bench runs its own docker commands, so they don't need to wait
+        for one another
+        """
+        benches = list(self.benches.values())
+
+        def run(bench):
             with suppress(Exception):
-                bench.stop()
+                action(bench)
+
+        with ThreadPoolExecutor(max_workers=min(16, len(benches) or 1)) as executor:
+            list(executor.map(run, benches))
 
     @property
     def benches(self) -> dict[str, Bench]:
-        benches = {}
-        for directory in os.listdir(self.benches_directory):
+        # Benches only appear or go away by creating or removing their directory
+        modified = os.stat(self.benches_directory).st_mtime_ns
+        cached = getattr(self, "_benches", None)
+        if cached and cached[0] == modified:
+            return dict(cached[1])
+
+        with os.scandir(self.benches_directory) as entries:
+            names = [entry.name for entry in entries if entry.is_dir()]
+
+        def load(name):
             with suppress(Exception):
-                benches[directory] = Bench(directory, self)
-        return benches
+                return Bench(name, self)
+
+        # Loading a bench only reads its config files, so benches can be loaded side by side
+        with ThreadPoolExecutor(max_workers=min(32, len(names) or 1)) as executor:
+            loaded = executor.map(load, names)
+            benches = {name: bench for name, bench in zip(names, loaded) if bench is not None}
+
+        # Directory mtimes are coarse, a bench added in the same tick wouldn't invalidate the cache.
+        # Benches still being set up fail to load, and finishing them doesn't touch the directory
+        if len(benches) == len(names) and time.time_ns() - modified > 1_000_000_000:
+            self._benches = (modified, benches)
+        return dict(benches)
 
     def get_bench(self, bench):
         try:
@@ -464,77 +553,205 @@ class Server(Base):
         self.step = value
 
     def update_agent_web(self, url=None, branch="master"):
-        directory = os.path.join(self.directory, "repo")
-        self.execute("git reset --hard", directory=directory)
-        self.execute("git clean -fd", directory=directory)
+        # One shell for the whole checkout, stopping at the first git command that fails
+        commands = ["git reset --hard", "git clean -fd"]
         if url:
-            self.execute(f"git remote set-url upstream {url}", directory=directory)
-        self.execute("git fetch upstream", directory=directory)
-        self.execute(f"git checkout {branch}", directory=directory)
-        self.execute(f"git merge --ff-only upstream/{branch}", directory=directory)
+            commands.append(f"git remote set-url upstream {url}")
+        commands += ["git fetch upstream", f"git checkout {branch}", f"git merge --ff-only upstream/{branch}"]
+        self.execute(" && ".join(commands), directory=self.repo_directory)
         self.execute("./env/bin/pip install -e repo", directory=self.directory)
 
         self._generate_redis_config()
         self._generate_supervisor_config()
-        self.execute("sudo supervisorctl reread")
-        self.execute("sudo supervisorctl restart agent:redis")
-
-        self.setup_nginx()
-        for worker in range(self.config["workers"]):
-            worker_name = f"agent:worker-{worker}"
-            self.execute(f"sudo supervisorctl restart {worker_name}")
-
-        self.execute("sudo supervisorctl restart agent:web")
+        self.execute(["sudo", "supervisorctl", "reread"])
+        # restart stops every named process before starting any of them, so redis gets its own call
+        # and stays up while the workers drain their jobs
+        self.execute(["sudo", "supervisorctl", "restart", "agent:redis"])
+
+        self.setup_nginx(reload=True)
+        # supervisorctl accepts multiple process names in one invocation,
+        # web stays last since this request is being served by it
+        workers = [f"agent:worker-{worker}" for worker in range(self.config["workers"])]
+        self.execute(["sudo", "supervisorctl", "restart", *workers, "agent:web"])
         run_patches()
 
     def update_agent_cli(self):
-        directory = os.path.join(self.directory, "repo")
-        self.execute("git reset --hard", directory=directory)
-        self.execute("git clean -fd", directory=directory)
-        self.execute("git fetch upstream", directory=directory)
-        self.execute("git merge --ff-only upstream/master", directory=directory)
+        directory = self.repo_directory
+        self.execute("git reset --hard && git clean -fd", directory=directory)
+        if not self._fast_forward_with_pygit2(directory, "master"):
+            self.execute("git fetch upstream && git merge --ff-only upstream/master", directory=directory)
 
         self.execute("./env/bin/pip install -e repo", directory=self.directory)
 
-        self.execute("sudo supervisorctl restart agent:")
-        self.setup_supervisor()
+        self.execute(["sudo", "supervisorctl", "restart", "agent:"])
+        self.setup_supervisor(update=True)
 
-        self.setup_nginx()
+        self.setup_nginx(reload=True)
         run_patches()
 
+    def _fast_forward_with_pygit2(self, directory, branch):
+        """
+        Fetch upstream and fast-forward the checked out branch in process
+        when pygit2 is installed
+
+        Returns False when pygit2 isn't available, the fetch or checkout
+        fails, or the branch can't be fast-forwarded, so the caller can
+        fall back to git. A checkout that fails partway is reset to the
+        original HEAD first. The attempt is logged like the git commands it
+        replaces.
+        """
+        try:
+            import pygit2
+        except ImportError:
+            return False
+
+        self.skip_output_log = False
+        self.data = get_execution_result(f"pygit2 fetch upstream && fast-forward {branch}", directory)
+        self.log()
+        fast_forwarded = False
+        repository = original_head = None
+        try:
+            repository = pygit2.Repository(directory)
+            repository.remotes["upstream"].fetch()
+            target = repository.lookup_reference(f"refs/remotes/upstream/{branch}").target
+            analysis, _ = repository.merge_analysis(target)
+            if analysis & pygit2.GIT_MERGE_ANALYSIS_UP_TO_DATE:
+                output, fast_forwarded = "Already up to date.", True
+            elif not analysis & pygit2.GIT_MERGE_ANALYSIS_FASTFORWARD:
+                output = f"Not possible to fast-forward to upstream/{branch}"
+            else:
+                original_head = repository.head.target
+                repository.checkout_tree(repository.get(target))
+                repository.head.set_target(target)
+                output, fast_forwarded = f"Fast-forwarded to {target}", True
+        except Exception as e:
+            output = f"{type(e).__name__}: {e}"
+            if original_head is not None:
+                # Don't leave a half checked out worktree for the git fallback
+                with suppress(Exception):
+                    repository.reset(original_head, pygit2.GIT_RESET_HARD)
+
+        end_execution(self.data, output, "Success" if fast_forwarded else "Failure")
+        self.log()
+        return fast_forwarded
+
     def get_agent_version(self):
-        directory = os.path.join(self.directory, "repo")
+        directory = self.repo_directory
+        try:
+            key = _git_head(directory), os.stat(os.path.join(directory, ".git", "config")).st_mtime_ns
+        except (OSError, ValueError):
+            key = None
+
+        cached = AGENT_VERSION_CACHE.get(directory)
+        if key is None or not cached or cached[0] != key:
+            cached = (
+                key,
+                {
+                    "commit": self.execute(["git", "rev-parse", "HEAD"], directory=directory)["output"],
+                    "upstream": self.execute(["git", "remote", "get-url", "upstream"], directory=directory)[
+                        "output"
+                    ],
+                    "show": self.execute(["git", "show"], directory=directory)["output"],
+                },
+            )
+            AGENT_VERSION_CACHE[directory] = cached
+
+        commit = cached[1]
         return {
-            "commit": self.execute("git rev-parse HEAD", directory=directory)["output"],
-            "status": self.execute("git status --short", directory=directory)["output"],
-            "upstream": self.execute("git remote get-url upstream", directory=directory)["output"],
-            "show": self.execute("git show", directory=directory)["output"],
+            "commit": commit["commit"],
+            "status": self.execute(["git", "status", "--short"], directory=directory)["output"],
+            "upstream": commit["upstream"],
+            "show": commit["show"],
             "python": platform.python_version(),
         }
 
     def status(self, mariadb_root_password):
+        # Overlap the CPU sampling window and MariaDB round trip with the supervisorctl and systemctl calls.
+        # Those two go through self.execute, which isn't re-entrant, so they stay on this thread.
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            mariadb = executor.submit(self.mariadb_processlist, mariadb_root_password=mariadb_root_password)
+            stats = executor.submit(self.stats)
+            processes = executor.submit(self.processes)
+            supervisor = self.supervisor_status()
+            nginx = self.nginx_status()
+            return {
+                "mariadb": mariadb.result(),
+                "supervisor": supervisor,
+                "nginx": nginx,
+                "stats": stats.result(),
+                "processes": processes.result(),
+                "timestamp": str(datetime.now()),
+            }
+
+    def _memory_stats(self):
+        # Same numbers (in MiB) as `free -t -m`, read straight from /proc/meminfo
+        fields = {
+            b"MemTotal",
+            b"MemFree",
+            b"MemAvailable",
+            b"Buffers",
+            b"Cached",
+            b"SReclaimable",
+            b"Shmem",
+            b"SwapTotal",
+            b"SwapFree",
+        }
+        meminfo = dict.fromkeys(fields, 0)
+        with open("/proc/meminfo", "rb") as f:
+            for line in f.read().splitlines():
+                key, _, value = line.partition(b":")
+                if key in fields:
+                    meminfo[key] = int(value.split()[0])
+
+        buff_cache = meminfo[b"Buffers"] + meminfo[b"Cached"] + meminfo[b"SReclaimable"]
+        # procps-ng 4 definition of used memory
+        mem_used = meminfo[b"MemTotal"] - meminfo[b"MemAvailable"]
+        swap_used = meminfo[b"SwapTotal"] - meminfo[b"SwapFree"]
+
         return {
-            "mariadb": self.mariadb_processlist(mariadb_root_password=mariadb_root_password),
-            "supervisor": self.supervisor_status(),
-            "nginx": self.nginx_status(),
-            "stats": self.stats(),
-            "processes": self.processes(),
-            "timestamp": str(datetime.now()),
+            "mem": {
+                "total": meminfo[b"MemTotal"] // 1024,
+                "used": mem_used // 1024,
+                "free": meminfo[b"MemFree"] // 1024,
+                "shared": meminfo[b"Shmem"] // 1024,
+                "buff/cache": buff_cache // 1024,
+                "available": meminfo[b"MemAvailable"] // 1024,
+            },
+            "swap": {
+                "total": meminfo[b"SwapTotal"] // 1024,
+                "used": swap_used // 1024,
+                "free": meminfo[b"SwapFree"] // 1024,
+            },
+            "total": {
+                "total": (meminfo[b"MemTotal"] + meminfo[b"SwapTotal"]) // 1024,
+                "used": (mem_used + swap_used) // 1024,
+                "free": (meminfo[b"MemFree"] + meminfo[b"SwapFree"]) // 1024,
+            },
         }
 
-    def _memory_stats(self):
-        free = self.execute("free -t -m")["output"].split("\n")
-        memory = {}
-        headers = free[0].split()
-        for line in free[1:]:
-            type, line = line.split(None, 1)
-            memory[type.lower()[:-1]] = dict(zip(headers, list(map(int, line.split()))))
-        return memory
+    def _read_proc_stat(self):
+        stats = {}
+        with open("/proc/stat", "rb") as f:
+            # cpu lines come first, skip intr, ctxt and the rest once they end
+            for line in f:
+                if not line.startswith(b"cpu"):
+                    break
+                type, *values = line.split()
+                stats[type.decode()] = list(map(int, values))
+        return stats
 
     def _cpu_stats(self):
-        prev_proc = self.execute("cat /proc/stat")["output"].split("\n")
-        time.sleep(0.5)
-        now_proc = self.execute("cat /proc/stat")["output"].split("\n")
+        # Usage is measured since the previous call when that was recent enough,
+        # otherwise over at least 200ms (still 20 ticks per cpu at HZ=100)
+        sampled, prev_proc = CPU_SAMPLE.get("previous", (0, None))
+        elapsed = time.monotonic() - sampled
+        if prev_proc is None or elapsed > 60:
+            prev_proc = self._read_proc_stat()
+            time.sleep(0.2)
+        elif elapsed < 0.2:
+            time.sleep(0.2 - elapsed)
+        now_proc = self._read_proc_stat()
+        CPU_SAMPLE["previous"] = (time.monotonic(), now_proc)
 
         # 0   user            Time spent in user mode.
         # 1   nice            Time spent in user mode with low priority
@@ -553,15 +770,14 @@ class Server(Base):
         # TOTAL = IDLE + NONIDLE
         # USAGE = TOTAL - IDLE / TOTAL
         cpu = {}
-        for prev, now in zip(prev_proc, now_proc):
-            if prev.startswith("cpu"):
-                type = prev.split()[0]
-                prev = list(map(int, prev.split()[1:]))
-                now = list(map(int, now.split()[1:]))
-
-                idle = (now[3] + now[4]) - (prev[3] + prev[4])
-                total = sum(now) - sum(prev)
-                cpu[type] = int(1000 * (total - idle) / total) / 10
+        for type, prev in prev_proc.items():
+            now = now_proc.get(type)
+            if not now:
+                continue
+
+            idle = (now[3] + now[4]) - (prev[3] + prev[4])
+            total = sum(now) - sum(prev)
+            cpu[type] = int(1000 * (total - idle) / total) / 10 if total else 0.0
         return cpu
 
     def stats(self):
@@ -580,32 +796,133 @@ class Server(Base):
         }
 
     def processes(self):
+        # Same rows as `ps --pid 2 --ppid 2 --deselect u`, read from /proc
         processes = []
         try:
-            output = self.execute("ps --pid 2 --ppid 2 --deselect u")["output"].split("\n")
-            headers = list(filter(None, output[0].split()))
-            rows = map(lambda s: s.strip().split(None, len(headers) - 1), output[1:])
-            processes = [dict(zip(headers, row)) for row in rows]
+            with open("/proc/uptime", "rb") as f:
+                uptime = float(f.read().split()[0])
+            now = time.time()
+            system = {
+                "now": now,
+                "today": time.localtime(now),
+                "uptime": uptime,
+                "clock_ticks": os.sysconf("SC_CLK_TCK"),
+                "page_size": os.sysconf("SC_PAGE_SIZE"),
+                "memory": os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 1024,
+                "users": {},
+            }
+            for pid in os.listdir("/proc"):
+                if not pid.isdigit():
+                    continue
+                # Processes can exit while we are walking /proc
+                with suppress(FileNotFoundError, ProcessLookupError):
+                    process = self._read_process(pid, system)
+                    if process:
+                        processes.append(process)
         except Exception:
             import traceback
 
             traceback.print_exc()
         return processes
 
+    def _read_process(self, pid, system):
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+        # comm can contain spaces and parentheses, so split after the last ")"
+        comm = stat[stat.index(b"(") + 1 : stat.rindex(b")")].decode(errors="replace")
+        fields = stat[stat.rindex(b")") + 2 :].split()
+
+        state = fields[0].decode()
+        ppid, pgrp, session, tty, tpgid = map(int, fields[1:6])
+        if pid == "2" or ppid == 2:
+            # Kernel threads
+            return None
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        nice, threads, _, start_ticks, vsize, rss = map(int, fields[16:22])
+
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            command = f.read().replace(b"\0", b" ").strip().decode(errors="replace")
+        # Like ps, show control characters (newlines, tabs, ...) as spaces and other unprintables as "?"
+        command = "".join(
+            " " if c < " " or c == "\x7f" else c if c.isprintable() else "?" for c in command or f"[{comm}]"
+        )
+
+        with open(f"/proc/{pid}/status", "rb") as f:
+            locked = any(line.startswith(b"VmLck:") and line.split()[1] != b"0" for line in f)
+
+        uid = os.stat(f"/proc/{pid}").st_uid
+        if uid not in system["users"]:
+            try:
+                system["users"][uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                system["users"][uid] = str(uid)
+
+        clock_ticks = system["clock_ticks"]
+        rss = rss * system["page_size"] // 1024
+        elapsed = system["uptime"] - start_ticks / clock_ticks
+        cpu = int(cpu_ticks * 1000 / clock_ticks / elapsed) if elapsed > 0 else 0
+        memory = rss * 1000 // system["memory"]
+
+        flags = "<" if nice < 0 else "N" if nice > 0 else ""
+        flags += "L" if locked else ""
+        flags += "s" if session == int(pid) else ""
+        flags += "l" if threads > 1 else ""
+        flags += "+" if tpgid == pgrp else ""
+
+        # Like procps, switch format on the calendar day and year rather than on elapsed time
+        started = time.localtime(system["now"] - elapsed)
+        today = system["today"]
+        if started.tm_year != today.tm_year:
+            start = time.strftime("%Y", started)
+        elif started.tm_yday != today.tm_yday:
+            start = time.strftime("%b%d", started)
+        else:
+            start = time.strftime("%H:%M", started)
+        cpu_seconds = cpu_ticks // clock_ticks
+
+        return {
+            "USER": system["users"][uid],
+            "PID": pid,
+            "%CPU": f"{cpu // 10}.{cpu % 10}",
+            "%MEM": f"{memory // 10}.{memory % 10}",
+            "VSZ": str(vsize // 1024),
+            "RSS": str(rss),
+            "TTY": _tty_name(tty),
+            "STAT": state + flags,
+            "START": start,
+            "TIME": f"{cpu_seconds // 60}:{cpu_seconds % 60:02}",
+            "COMMAND": command,
+        }
+
     def mariadb_processlist(self, mariadb_root_password):
         processes = []
         try:
-            mariadb = MySQLDatabase(
-                "mysql",
-                user="root",
-                password=mariadb_root_password,
-                host="localhost",
-                port=3306,
-            )
-            cursor = mariadb.execute_sql("SHOW PROCESSLIST")
-            rows = cursor.fetchall()
-            columns = [d[0] for d in cursor.description]
-            processes = list(map(lambda x: dict(zip(columns, x)), rows))
+            # Reused across status polls, so that each one doesn't pay for a new connection and login
+            with MARIADB_LOCK:
+                mariadb = MARIADB_CONNECTIONS.get(mariadb_root_password)
+                if mariadb is None:
+                    for connection in MARIADB_CONNECTIONS.values():
+                        with suppress(Exception):
+                            connection.close()
+                    MARIADB_CONNECTIONS.clear()
+                    mariadb = MARIADB_CONNECTIONS[mariadb_root_password] = MySQLDatabase(
+                        "mysql",
+                        user="root",
+                        password=mariadb_root_password,
+                        host="localhost",
+                        port=3306,
+                        thread_safe=False,
+                    )
+                try:
+                    cursor = mariadb.execute_sql("SHOW PROCESSLIST")
+                except (InterfaceError, OperationalError):
+                    # The server may have dropped the idle connection since the last poll
+                    with suppress(Exception):
+                        mariadb.close()
+                    cursor = mariadb.execute_sql("SHOW PROCESSLIST")
+                rows = cursor.fetchall()
+                columns = [d[0] for d in cursor.description]
+            processes = [dict(zip(columns, row)) for row in rows]
         except Exception:
             import traceback
 
@@ -616,26 +933,18 @@ class Server(Base):
         status = []
         try:
             try:
-                supervisor = self.execute(f"sudo supervisorctl status {name}")
+                supervisor = self.execute(["sudo", "supervisorctl", "status", name])
             except AgentException as e:
                 supervisor = e.data
 
-            for process in supervisor["output"].split("\n"):
-                name, description = process.split(None, 1)
-
-                name, *group = name.strip().split(":")
-                group = group[0] if group else ""
-
-                state, *description = description.strip().split(None, 1)
-                state = state.strip()
-                description = description[0].strip() if description else ""
-
+            for process in SUPERVISOR_STATUS_PATTERN.finditer(supervisor["output"]):
+                state = process["state"]
                 status.append(
                     {
-                        "name": name,
-                        "group": group,
+                        "name": process["name"],
+                        "group": process["group"] or "",
                         "state": state,
-                        "description": description,
+                        "description": process["description"],
                         "online": state == "RUNNING",
                     }
                 )
@@ -646,43 +955,42 @@ class Server(Base):
         return status
 
     def nginx_status(self):
-        try:
-            systemd = self.execute("sudo systemctl status nginx")
-        except AgentException as e:
-            systemd = e.data
-        return systemd["output"]
+        # One word (active, inactive, failed, ...) instead of the full unit status and journal tail
+        return self.execute(["systemctl", "is-active", "nginx"], non_zero_throw=False)["output"]
 
     def _generate_nginx_config(self):
         nginx_config = os.path.join(self.nginx_directory, "nginx.conf")
-        self._render_template(
+        config = self.config
+        return self._render_template(
             "nginx/nginx.conf.jinja2",
             {
-                "proxy_ip": self.config.get("proxy_ip"),
-                "tls_protocols": self.config.get("tls_protocols"),
-                "nginx_vts_module_enabled": self.config.get("nginx_vts_module_enabled", True),
-                "ip_whitelist": self.config.get("ip_whitelist", []),
+                "proxy_ip": config.get("proxy_ip"),
+                "tls_protocols": config.get("tls_protocols"),
+                "nginx_vts_module_enabled": config.get("nginx_vts_module_enabled", True),
+                "ip_whitelist": config.get("ip_whitelist", []),
             },
             nginx_config,
         )
 
     def _generate_agent_nginx_config(self):
         agent_nginx_config = os.path.join(self.directory, "nginx.conf")
-        self._render_template(
+        config = self.config
+        return self._render_template(
             "agent/nginx.conf.jinja2",
             {
-                "web_port": self.config["web_port"],
+                "web_port": config["web_port"],
                 "name": self.name,
-                "registry": self.config.get("registry", False),
-                "monitor": self.config.get("monitor", False),
-                "log": self.config.get("log", False),
-                "analytics": self.config.get("analytics", False),
-                "trace": self.config.get("trace", False),
-                "tls_directory": self.config["tls_directory"],
+                "registry": config.get("registry", False),
+                "monitor": config.get("monitor", False),
+                "log": config.get("log", False),
+                "analytics": config.get("analytics", False),
+                "trace": config.get("trace", False),
+                "tls_directory": config["tls_directory"],
                 "nginx_directory": self.nginx_directory,
-                "nginx_vts_module_enabled": self.config.get("nginx_vts_module_enabled", True),
-                "pages_directory": os.path.join(self.directory, "repo", "agent", "pages"),
-                "tls_protocols": self.config.get("tls_protocols"),
-                "press_url": self.config.get("press_url"),
+                "nginx_vts_module_enabled": config.get("nginx_vts_module_enabled", True),
+                "pages_directory": self.error_pages_directory,
+                "tls_protocols": config.get("tls_protocols"),
+                "press_url": config.get("press_url"),
             },
             agent_nginx_config,
         )
@@ -697,39 +1005,59 @@ class Server(Base):
 
     def _generate_supervisor_config(self):
         supervisor_config = os.path.join(self.directory, "supervisor.conf")
-        self._render_template(
+        config = self.config
+        return self._render_template(
             "agent/supervisor.conf.jinja2",
             {
-                "web_port": self.config["web_port"],
-                "redis_port": self.config["redis_port"],
-                "gunicorn_workers": self.config.get("gunicorn_workers", 2),
-                "workers": self.config["workers"],
+                "web_port": config["web_port"],
+                "redis_port": config["redis_port"],
+                "gunicorn_workers": config.get("gunicorn_workers", 2),
+                "workers": config["workers"],
                 "directory": self.directory,
-                "user": self.config["user"],
-                "sentry_dsn": self.config.get("sentry_dsn"),
+                "user": config["user"],
+                "sentry_dsn": config.get("sentry_dsn"),
             },
             supervisor_config,
         )
 
     def _reload_nginx(self):
-        return self.execute("sudo systemctl reload nginx")
+        return self.execute(["sudo", "systemctl", "reload", "nginx"])
 
     def _render_template(self, template, context, outfile, options=None):
-        if options is None:
-            options = {}
-        options.update({"loader": PackageLoader("agent", "templates")})
-        environment = Environment(**options)
+        environment = _template_environment(tuple(sorted((options or {}).items())))
         template = environment.get_template(template)
+        rendered = template.render(**context)
+
+        # Leave identical files alone so callers can skip reloading the service that reads them
+        with suppress(FileNotFoundError), open(outfile) as f:
+            if f.read() == rendered:
+                return False
 
         with open(outfile, "w") as f:
-            f.write(template.render(**context))
+            f.write(rendered)
+        return True
 
     def _update_supervisor(self):
-        self.execute("sudo supervisorctl reread")
-        self.execute("sudo supervisorctl update")
+        # update rereads the configuration itself before applying the changes
+        self.execute(["sudo", "supervisorctl", "update"])
 
     def _get_tree_size(self, path):
-        return self.execute(f"du -sh {path}")["output"].split()[0]
+        with suppress(OSError):
+            return _human_size(_tree_bytes(path))
+        return None
+
+    def _get_tree_sizes(self, paths: list[str]) -> dict[str, str]:
+        """
+        Size paths like separate `du -sh` calls would, walking them in process
+        instead of spawning du
+
+        The walks are independent and mostly wait on the filesystem, so paths
+        are sized side by side. Paths that can't be read are left out of the
+        result
+        """
+        with ThreadPoolExecutor(max_workers=min(8, len(paths) or 1)) as executor:
+            sizes = executor.map(self._get_tree_size, paths)
+            return {path: size for path, size in zip(paths, sizes) if size is not None}
 
     def long_method(
         self,
@@ -758,8 +1086,120 @@ class Server(Base):
 
     @property
     def wildcards(self) -> list[str]:
+        modified = os.stat(self.hosts_directory).st_mtime_ns
+        cached = WILDCARDS_CACHE.get(self.hosts_directory)
+        if cached and cached[0] == modified:
+            return list(cached[1])
+
         wildcards = []
-        for host in os.listdir(self.hosts_directory):
-            if "*" in host:
-                wildcards.append(host.strip("*."))
-        return wildcards
+        with os.scandir(self.hosts_directory) as hosts:
+            for host in hosts:
+                if "*" in host.name:
+                    wildcards.append(host.name.strip("*."))
+
+        # Directory mtimes are coarse, a host added in the same tick wouldn't invalidate the cache
+        if time.time_ns() - modified > 1_000_000_000:
+            WILDCARDS_CACHE[self.hosts_directory] = (modified, wildcards)
+        return list(wildcards)
+
+
+def _tty_name(tty_nr: int) -> str:
+    major = (tty_nr >> 8) & 0xFFF
+    minor = (tty_nr & 0xFF) | ((tty_nr >> 12) & 0xFFF00)
+    if major == 0:
+        return "?"
+    if 136 <= major <= 143:
+        return f"pts/{minor + (major - 136) * 256}"
+    if major == 4 and minor < 64:
+        return f"tty{minor}"
+    if major == 4:
+        return f"ttyS{minor - 64}"
+    return f"{major},{minor}"
+
+
+@lru_cache(maxsize=None)
+def _template_environment(options: tuple) -> Environment:
+    """
+    Environment shared by every render with the same options, so that each
+    template is loaded and compiled only once per process. Templates are
+    still checked for changes on every render, so long running processes
+    pick up sources updated by an agent update
+
+    Compiled templates are also kept on disk (in a per user directory under
+    the temp directory), so that each forked job doesn't compile them again
+    """
+    return Environment(
+        loader=PackageLoader("agent", "templates"),
+        cache_size=-1,
+        bytecode_cache=FileSystemBytecodeCache(),
+        **dict(options),
+    )
+
+
+def _git_head(repository: str) -> str:
+    """
+    Commit HEAD points to, resolved from the files under .git without running git
+    """
+    git_directory = os.path.join(repository, ".git")
+    with open(os.path.join(git_directory, "HEAD")) as f:
+        head = f.read().strip()
+    if not head.startswith("ref: "):
+        return head
+
+    ref = head[5:]
+    with suppress(FileNotFoundError), open(os.path.join(git_directory, ref)) as f:
+        return f.read().strip()
+    with open(os.path.join(git_directory, "packed-refs")) as f:
+        for line in f:
+            commit, _, name = line.rstrip("\n").partition(" ")
+            if name == ref:
+                return commit
+    raise ValueError(f"Unable to resolve {ref}")
+
+
+def _tree_bytes(path: str) -> int:
+    """
+    Disk usage of path in bytes, counted like `du`: allocated blocks of every
+    entry, without following symlinks and counting hardlinked files once
+    """
+    stat = os.lstat(path)
+    total = stat.st_blocks * 512
+    seen = set()
+    stack = [path] if os.path.isdir(path) and not os.path.islink(path) else []
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                except OSError:
+                    continue
+                if stat.st_nlink > 1 and not entry.is_dir(follow_symlinks=False):
+                    inode = (stat.st_dev, stat.st_ino)
+                    if inode in seen:
+                        continue
+                    seen.add(inode)
+                total += stat.st_blocks * 512
+    return total
+
+
+def _human_size(size: int) -> str:
+    """
+    Format bytes the way `du -h` does, rounding up to one decimal below 10
+    """
+    if size < 1024:
+        return str(size)
+    units = iter("KMGTPE")
+    unit = next(units)
+    size /= 1024
+    while math.ceil(size) >= 1024 and unit != "E":
+        unit = next(units)
+        size /= 1024
+    if size < 10 and math.ceil(size * 10) < 100:
+        return f"{math.ceil(size * 10) / 10:.1f}{unit}"
+    return f"{math.ceil(size)}{unit}"
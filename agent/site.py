@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import copy
 import json
 import os
 import re
 import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from shlex import quote
 from typing import TYPE_CHECKING
@@ -19,6 +22,14 @@ from agent.utils import b2mb, compute_file_hash, get_size
 if TYPE_CHECKING:
     from agent.bench import Bench
 
+# Session id printed by the console snippet in Site.sid, and the one in the URL printed by `bench browse`
+SID_PATTERN = re.compile(r">>>(.*?)<<<")
+SID_URL_PATTERN = re.compile(r"\?sid=([a-z0-9]*)")
+
+# Shared across Site instances so that repeated pings reuse their kept-alive connections
+PING_SESSION = requests.Session()
+PING_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=64))
+
 
 class Site(Base):
     def __init__(self, name: str, bench: Bench):
@@ -41,10 +52,11 @@ class Site(Base):
         if not os.path.exists(self.config_file):
             raise OSError(f"Path {self.config_file} does not exist")
 
-        self.database = self.config["db_name"]
-        self.user = self.config["db_name"]
-        self.password = self.config["db_password"]
-        self.host = self.config.get("db_host", self.bench.host)
+        config = self.config
+        self.database = config["db_name"]
+        self.user = config["db_name"]
+        self.password = config["db_password"]
+        self.host = config.get("db_host", self.bench.host)
 
     def bench_execute(self, command, input=None):
         return self.bench.docker_execute(f"bench --site {self.name} {command}", input=input)
@@ -131,22 +143,24 @@ class Site(Base):
 
     @step("Checksum of Downloaded Backup Files")
     def calculate_checksum_of_backup_files(self, database_file, public_file, private_file):
-        database_file_sha256 = compute_file_hash(database_file, algorithm="sha256", raise_exception=False)
-
-        data = f"""Database File
-> File Name - {os.path.basename(database_file)}
-> SHA256 Checksum - {database_file_sha256}\n"""
+        files = {"Database File": database_file}
         if public_file:
-            public_file_sha256 = compute_file_hash(public_file, algorithm="sha256", raise_exception=False)
-            data += f"""\nPublic File
-> File Name - {os.path.basename(public_file)}
-> SHA256 Checksum - {public_file_sha256}\n"""
+            files["Public File"] = public_file
         if private_file:
-            private_file_sha256 = compute_file_hash(private_file, algorithm="sha256", raise_exception=False)
-            data += f"""\nPrivate File
-> File Name - {os.path.basename(private_file)}
-> SHA256 Checksum - {private_file_sha256}\n"""
+            files["Private File"] = private_file
+        # hashlib releases the GIL while hashing, so the files are checksummed in parallel
+        with ThreadPoolExecutor(max_workers=len(files)) as executor:
+            checksums = executor.map(
+                lambda file: compute_file_hash(file, algorithm="sha256", raise_exception=False),
+                files.values(),
+            )
 
+        data = "\n".join(
+            f"""{title}
+> File Name - {os.path.basename(file)}
+> SHA256 Checksum - {checksum}\n"""
+            for (title, file), checksum in zip(files.items(), checksums)
+        )
         return {"output": data}
 
     @job("Restore Site")
@@ -420,6 +434,7 @@ class Site(Base):
     @step("Upload Site Backup to S3")
     def upload_offsite_backup(self, backup_files, offsite):
         import boto3
+        from boto3.s3.transfer import TransferConfig
 
         offsite_files = {}
         bucket, auth, prefix = (
@@ -443,13 +458,26 @@ class Site(Base):
                 aws_secret_access_key=auth["SECRET_KEY"],
             )
 
+        uploads = []
         for backup_file in backup_files.values():
             file_name = backup_file["file"].split(os.sep)[-1]
             offsite_path = os.path.join(prefix, file_name)
             offsite_files[file_name] = offsite_path
+            uploads.append((backup_file["path"], offsite_path))
 
-            with open(backup_file["path"], "rb") as data:
-                s3.upload_fileobj(data, bucket, offsite_path)
+        # Upload the files side by side, each one in concurrent multipart chunks
+        config = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=16 * 1024 * 1024,
+            max_concurrency=10,
+        )
+        with ThreadPoolExecutor(max_workers=len(uploads) or 1) as executor:
+            futures = [
+                executor.submit(s3.upload_file, path, bucket, offsite_path, Config=config)
+                for path, offsite_path in uploads
+            ]
+            for future in futures:
+                future.result()
 
         return offsite_files
 
@@ -491,19 +519,55 @@ class Site(Base):
         with open(self.previous_tables_file, "w") as ptf:
             json.dump(tables, ptf, indent=4, sort_keys=True)
 
-        data = {"tables": {}}
-        for table in tables:
-            backup_file = os.path.join(self.backup_directory, f"{table}.sql.gz")
-            output = self.execute(
-                "set -o pipefail && "
-                "mysqldump --single-transaction --quick --lock-tables=false "
-                f"-h {self.host} -u {self.user} -p{self.password} "
-                f"{self.database} '{table}' "
-                f" | gzip > '{backup_file}'",
-                executable="/bin/bash",
-            )
-            data["tables"][table] = output
-        return data
+        # Tables are dumped independently, a few at a time so that MariaDB isn't swamped.
+        # Workers stop taking tables after the first failure, so a dead database or a full disk
+        # fails the step after one dump instead of after every table.
+        outputs = {}
+        pending = iter(tables)
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def backup(worker):
+            while not failed.is_set():
+                with lock:
+                    table = next(pending, None)
+                if table is None:
+                    return
+                try:
+                    outputs[table] = worker._backup_table(table)
+                except Exception:
+                    failed.set()
+                    raise
+
+        workers = min(4, os.cpu_count() or 1, len(tables) or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(backup, self._table_backup_worker()) for _ in range(workers)]
+            for future in futures:
+                future.result()
+        return {"tables": {table: outputs[table] for table in tables}}
+
+    def _table_backup_worker(self):
+        """
+        Copy of this site for a tablewise backup thread
+
+        execute keeps per-call state on the instance, so every thread needs
+        its own. The copy shares the already read credentials and doesn't
+        publish its output to the step this site reports to.
+        """
+        worker = copy.copy(self)
+        worker.get_redis_key = lambda: None
+        return worker
+
+    def _backup_table(self, table):
+        backup_file = os.path.join(self.backup_directory, f"{table}.sql.gz")
+        return self.execute(
+            "set -o pipefail && "
+            "mysqldump --single-transaction --quick --lock-tables=false "
+            f"-h {self.host} -u {self.user} -p{self.password} "
+            f"{self.database} '{table}' "
+            f" | gzip > '{backup_file}'",
+            executable="/bin/bash",
+        )
 
     @step("Run App Specific Scripts")
     def run_app_scripts(self, scripts: dict[str, str]):
@@ -619,7 +683,7 @@ class Site(Base):
         }
         try:
             ping_url = f"https://{self.name}/api/method/ping"
-            data["web"] = requests.get(ping_url).status_code == 200
+            data["web"] = PING_SESSION.get(ping_url, timeout=10).status_code == 200
         except Exception:
             data["web"] = False
 
@@ -662,10 +726,10 @@ print(">>>" + frappe.session.sid + "<<<")
 """
 
         output = self.bench_execute("console", input=code)["output"]
-        sid = re.search(r">>>(.*)<<<", output).group(1)
+        sid = SID_PATTERN.search(output).group(1)
         if not sid or sid == user or sid == "Guest":  # case when it fails
             output = self.bench_execute(f"browse --user {user}")["output"]
-            sid = re.search(r"\?sid=([a-z0-9]*)", output).group(1)
+            sid = SID_URL_PATTERN.search(output).group(1)
         return sid
 
     @property
@@ -715,11 +779,12 @@ print(">>>" + frappe.session.sid + "<<<")
     @step("Optimize Tables")
     def optimize_tables(self):
         tables = [row[0] for row in self.get_database_free_tables()]
-        for table in tables:
-            query = f"OPTIMIZE TABLE `{table}`"
-            self.execute(
-                f"mysql -sN -h {self.host} -u{self.user} -p{self.password}" f" {self.database} -e '{query}'"
-            )
+        result = self.db_instance().optimize_tables(tables)
+        output = [f"Optimized {len(result['optimized_tables'])} tables"]
+        output += [
+            f"Failed to optimize {table}: {error}" for table, error in result["failed_optimizations"].items()
+        ]
+        return {"output": "\n".join(output), **result}
 
     def fetch_latest_backup(self, with_files=True):
         databases, publics, privates, site_configs = [], [], [], []
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import unittest
 from shlex import quote
+from unittest.mock import patch
 
 from testcontainers.mysql import MySqlContainer
 
@@ -135,6 +136,26 @@ class TestDatabase(unittest.TestCase):
     def _db(self, db_name: str, username: str, password: str) -> Database:
         return Database(self.instance.host, self.instance.port, username, password, db_name)
 
+    # Test cases for optimize_tables method
+    def test_optimize_tables_in_batches(self):
+        db = self._db(self.db1__name, self.db1__username, self.db1__password)
+        tables = [f"Log{index}" for index in range(55)] + ["Odd`Name"]
+        db._run_sql(
+            ";\n".join(f"CREATE TABLE `{table.replace('`', '``')}` (id int)" for table in tables),
+            commit=True,
+        )
+
+        with patch.object(db, "_run_sql", wraps=db._run_sql) as run_sql:
+            result = db.optimize_tables([*tables, "Missing"])
+
+        # 57 tables go out as two OPTIMIZE TABLE statements
+        queries = run_sql.call_args.args[0].split(";\n")
+        self.assertEqual(len(queries), 2)
+        self.assertIn("`Odd``Name`", queries[1])
+        self.assertEqual(sorted(result["optimized_tables"]), sorted(tables))
+        self.assertEqual(list(result["failed_optimizations"]), ["Missing"])
+        self.assertIn("doesn't exist", result["failed_optimizations"]["Missing"])
+
     # Test cases for _run_sql method
     def test_run_sql_fn(self):
         """Basic test for `_run_sql` function"""
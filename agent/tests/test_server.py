@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import io
+import os
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import MagicMock, mock_open, patch
+
+from peewee import MySQLDatabase
+
+from agent.server import MARIADB_CONNECTIONS, Server, _human_size
+
+MEMINFO = b"""MemTotal:        6147400 kB
+MemFree:         4834340 kB
+MemAvailable:    5639928 kB
+Buffers:           66764 kB
+Cached:           939316 kB
+SwapCached:            0 kB
+SwapTotal:       2097148 kB
+SwapFree:        1048576 kB
+Shmem:              9176 kB
+SReclaimable:      31620 kB
+"""
+
+# Started 23:25 yesterday with 3 threads, 3s of CPU, 10 MiB resident and locked memory
+PROCESS_FILES = {
+    "/proc/1234/stat": b"1234 (python3 (x)) S 1 1234 1234 0 -1 4194560 100 0 0 0 250 50 0 0 20 0 3 0 730000 "
+    b"104857600 2560 18446744073709551615 1 1 0 0 0 0 0 16781312 0 0 0 17 1 0 0 0 0 0",
+    "/proc/1234/cmdline": b"python3\0-c\0print(1)\nexit()\0",
+    "/proc/1234/status": b"Name:\tpython3\nVmLck:\t    4096 kB\nThreads:\t3\n",
+}
+
+
+class TestServer(unittest.TestCase):
+    """Tests for class methods of Server."""
+
+    def _get_fake_server(self):
+        with patch.object(Server, "__init__", new=lambda x: None):
+            return Server()
+
+    def test_memory_stats_matches_free_output(self):
+        """Ensure memory stats are built from /proc/meminfo like `free -t -m`."""
+        server = self._get_fake_server()
+        with patch("builtins.open", mock_open(read_data=MEMINFO)):
+            memory = server._memory_stats()
+
+        self.assertEqual(
+            memory["mem"],
+            {
+                "total": 6003,
+                "used": 495,
+                "free": 4721,
+                "shared": 8,
+                "buff/cache": 1013,
+                "available": 5507,
+            },
+        )
+        self.assertEqual(memory["swap"], {"total": 2047, "used": 1023, "free": 1024})
+        self.assertEqual(memory["total"], {"total": 8051, "used": 1519, "free": 5745})
+
+    def test_read_process_matches_ps_output(self):
+        """Ensure a process is read from /proc into the same row as `ps u`."""
+        server = self._get_fake_server()
+        timezone = os.environ.get("TZ")
+        os.environ["TZ"] = "UTC"
+        time.tzset()
+        self.addCleanup(time.tzset)
+        if timezone is None:
+            self.addCleanup(os.environ.pop, "TZ")
+        else:
+            self.addCleanup(os.environ.__setitem__, "TZ", timezone)
+
+        now = 1792195800  # 2026-10-17 00:10 UTC, 45 minutes after the process started
+        system = {
+            "now": now,
+            "today": time.localtime(now),
+            "uptime": 10000,
+            "clock_ticks": 100,
+            "page_size": 4096,
+            "memory": 1024000,
+            "users": {0: "root"},
+        }
+        with patch("builtins.open", lambda path, mode="r": io.BytesIO(PROCESS_FILES[path])), patch(
+            "os.stat", return_value=os.stat_result((0,) * 10)
+        ):
+            process = server._read_process("1234", system)
+
+        self.assertEqual(
+            process,
+            {
+                "USER": "root",
+                "PID": "1234",
+                "%CPU": "0.1",
+                "%MEM": "1.0",
+                "VSZ": "102400",
+                "RSS": "10240",
+                "TTY": "?",
+                "STAT": "SLsl",
+                "START": "Oct16",
+                "TIME": "0:03",
+                "COMMAND": "python3 -c print(1) exit()",
+            },
+        )
+
+    def test_supervisor_status_parses_processes(self):
+        """Ensure supervisorctl status output is parsed into process dicts."""
+        server = self._get_fake_server()
+        output = (
+            "agent:redis                      RUNNING   pid 4301, uptime 2 days, 1:02:03\n"
+            "agent:worker-0                   STOPPED   Not started\n"
+            "nginx                            FATAL     \n"
+            "agent:web: ERROR (no such process)"
+        )
+        with patch.object(Server, "execute", return_value={"output": output}):
+            status = server.supervisor_status()
+
+        self.assertEqual(
+            status,
+            [
+                {
+                    "name": "agent",
+                    "group": "redis",
+                    "state": "RUNNING",
+                    "description": "pid 4301, uptime 2 days, 1:02:03",
+                    "online": True,
+                },
+                {
+                    "name": "agent",
+                    "group": "worker-0",
+                    "state": "STOPPED",
+                    "description": "Not started",
+                    "online": False,
+                },
+                {
+                    "name": "nginx",
+                    "group": "",
+                    "state": "FATAL",
+                    "description": "",
+                    "online": False,
+                },
+                {
+                    "name": "agent",
+                    "group": "web",
+                    "state": "ERROR",
+                    "description": "(no such process)",
+                    "online": False,
+                },
+            ],
+        )
+
+    def test_human_size_matches_du_output(self):
+        """Ensure sizes are formatted like `du -h`."""
+        self.assertEqual(_human_size(0), "0")
+        self.assertEqual(_human_size(4096), "4.0K")
+        self.assertEqual(_human_size(1536 * 1024 + 1), "1.6M")
+        self.assertEqual(_human_size(12 * 1024**3), "12G")
+        self.assertEqual(_human_size(1024**2 - 1), "1.0M")
+
+    def test_get_tree_sizes_skips_unreadable_paths(self):
+        """Ensure every readable path is sized and missing ones are left out."""
+        server = self._get_fake_server()
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ("a", "b", "missing")]
+            for path in paths[:2]:
+                os.mkdir(path)
+                with open(os.path.join(path, "file"), "wb") as f:
+                    f.write(b"x" * 10000)
+
+            sizes = server._get_tree_sizes(paths)
+
+        self.assertEqual(list(sizes), paths[:2])
+        self.assertTrue(all(size.endswith("K") for size in sizes.values()))
+
+    def test_render_template_skips_unchanged_file(self):
+        """Ensure re-rendering identical content reports no change."""
+        server = self._get_fake_server()
+        context = {"redis_port": 25025}
+        with tempfile.TemporaryDirectory() as directory:
+            outfile = os.path.join(directory, "redis.conf")
+            self.assertTrue(server._render_template("agent/redis.conf.jinja2", context, outfile))
+            self.assertFalse(server._render_template("agent/redis.conf.jinja2", context, outfile))
+            context["redis_port"] = 25026
+            self.assertTrue(server._render_template("agent/redis.conf.jinja2", context, outfile))
+
+    def test_setup_nginx_reloads_when_forced(self):
+        """Ensure an explicit setup reloads nginx even when its config is unchanged."""
+        server = self._get_fake_server()
+        with patch.multiple(
+            Server,
+            _generate_nginx_config=lambda self: False,
+            _generate_agent_nginx_config=lambda self: False,
+            _reload_nginx=MagicMock(),
+        ):
+            server.setup_nginx()
+            Server._reload_nginx.assert_not_called()
+            server.setup_nginx(reload=True)
+            Server._reload_nginx.assert_called_once()
+
+    def test_setup_supervisor_updates_when_forced(self):
+        """Ensure an explicit setup runs supervisorctl update even when its config is unchanged."""
+        server = self._get_fake_server()
+        with patch.multiple(
+            Server,
+            _generate_redis_config=lambda self: False,
+            _generate_supervisor_config=lambda self: False,
+            _update_supervisor=MagicMock(),
+        ):
+            server.setup_supervisor()
+            Server._update_supervisor.assert_not_called()
+            server.setup_supervisor(update=True)
+            Server._update_supervisor.assert_called_once()
+
+    def test_fast_forward_with_pygit2_falls_back_on_git_error(self):
+        """Ensure a failing pygit2 fetch is logged and leaves the update to git."""
+        server = self._get_fake_server()
+
+        class GitError(Exception):
+            pass
+
+        repository = MagicMock()
+        repository.remotes["upstream"].fetch.side_effect = GitError("authentication required")
+        pygit2 = SimpleNamespace(GitError=GitError, Repository=MagicMock(return_value=repository))
+
+        with patch.dict(sys.modules, {"pygit2": pygit2}), patch.object(Server, "log") as log:
+            self.assertFalse(server._fast_forward_with_pygit2("/home/frappe/agent/repo", "master"))
+
+        self.assertEqual(log.call_count, 2)
+        self.assertEqual(server.data["status"], "Failure")
+        self.assertEqual(server.data["output"], "GitError: authentication required")
+
+    def test_fast_forward_with_pygit2_resets_failed_checkout(self):
+        """Ensure a checkout that fails partway is reset before falling back to git."""
+        server = self._get_fake_server()
+        repository = MagicMock()
+        repository.merge_analysis.return_value = (4, None)
+        repository.head.target = "original"
+        repository.checkout_tree.side_effect = PermissionError("apps.txt")
+        pygit2 = SimpleNamespace(
+            Repository=MagicMock(return_value=repository),
+            GIT_MERGE_ANALYSIS_UP_TO_DATE=2,
+            GIT_MERGE_ANALYSIS_FASTFORWARD=4,
+            GIT_RESET_HARD=3,
+        )
+
+        with patch.dict(sys.modules, {"pygit2": pygit2}), patch.object(Server, "log"):
+            self.assertFalse(server._fast_forward_with_pygit2("/home/frappe/agent/repo", "master"))
+
+        repository.reset.assert_called_once_with("original", 3)
+        repository.head.set_target.assert_not_called()
+        self.assertEqual(server.data["output"], "PermissionError: apps.txt")
+
+    def test_mariadb_processlist_reuses_connection_across_threads(self):
+        """Ensure status polls from different threads share one MariaDB connection."""
+        server = self._get_fake_server()
+        connection = MagicMock(server_version="10.6.16-MariaDB")
+        cursor = connection.cursor.return_value
+        cursor.description = [("Id",), ("User",)]
+        cursor.fetchall.return_value = [(1, "root")]
+        MARIADB_CONNECTIONS.clear()
+        self.addCleanup(MARIADB_CONNECTIONS.clear)
+
+        with patch.object(MySQLDatabase, "_connect", return_value=connection) as connect:
+            for _ in range(2):
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    processes = executor.submit(server.mariadb_processlist, "password").result()
+                self.assertEqual(processes, [{"Id": 1, "User": "root"}])
+
+        connect.assert_called_once()
+
+    def test_status_returns_every_component(self):
+        """Ensure status() still gathers every component when run concurrently."""
+        server = self._get_fake_server()
+        with patch.multiple(
+            Server,
+            mariadb_processlist=lambda self, mariadb_root_password: ["mariadb"],
+            supervisor_status=lambda self: ["supervisor"],
+            nginx_status=lambda self: "active",
+            stats=lambda self: {"cpu": {}},
+            processes=lambda self: ["processes"],
+        ):
+            status = server.status("password")
+
+        self.assertEqual(
+            set(status),
+            {"mariadb", "supervisor", "nginx", "stats", "processes", "timestamp"},
+        )
+        self.assertEqual(status["mariadb"], ["mariadb"])
+        self.assertEqual(status["supervisor"], ["supervisor"])
+        self.assertEqual(status["nginx"], "active")
+        self.assertEqual(status["stats"], {"cpu": {}})
+        self.assertEqual(status["processes"], ["processes"])
@@ -124,3 +124,24 @@ class TestSite(unittest.TestCase):
             bench.valid_sites[site_name]
         except KeyError:
             self.fail("Site not found in bench.sites")
+
+    def test_tablewise_backup_stops_after_first_failure(self):
+        """Ensure a failing table dump stops the remaining tables from being dumped."""
+        bench = self._get_test_bench()
+        site_name = "backup-site"
+        self._create_test_site(site_name)
+        with patch.object(Site, "config"):
+            site = Site(site_name, bench)
+        tables = [f"tab{index}" for index in range(20)]
+
+        def backup_table(table):
+            if table == "tab0":
+                raise AgentException({"output": "mysqldump: Got error: 2002"})
+            return {"output": ""}
+
+        with patch.object(Site, "tables", new=tables), patch.object(
+            Site, "_backup_table", side_effect=backup_table
+        ) as backup, self.assertRaises(AgentException):
+            Site.tablewise_backup.__wrapped__(site)
+
+        self.assertLess(backup.call_count, len(tables))
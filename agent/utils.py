@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import errno
+import fcntl
 import hashlib
 import os
+import shutil
+import stat
 from datetime import datetime, timedelta
 from math import ceil
 from typing import TYPE_CHECKING
@@ -31,6 +35,10 @@ if TYPE_CHECKING:
         traceback: str | None
 
 
+# ioctl that makes a file share the data extents of another, from linux/fs.h
+FICLONE = 0x40049409
+
+
 def download_file(url, prefix):
     """Download file locally under path prefix and return local path"""
     filename = urlparse(url).path.split("/")[-1]
@@ -124,12 +132,16 @@ def end_execution(
 def compute_file_hash(file_path, algorithm="sha256", raise_exception=True):
     try:
         """Compute the hash of a file using the specified algorithm."""
-        hash_func = hashlib.new(algorithm)
+        with open(file_path, "rb", buffering=0) as file:
+            if hasattr(hashlib, "file_digest"):
+                # Python 3.11+, reads into a reused buffer and hashes without holding the GIL
+                return hashlib.file_digest(file, algorithm).hexdigest()
 
-        with open(file_path, "rb") as file:
-            # read in 10MB chunks
-            while chunk := file.read(10000000):
-                hash_func.update(chunk)
+            hash_func = hashlib.new(algorithm)
+            buffer = bytearray(1024 * 1024)
+            view = memoryview(buffer)
+            while size := file.readinto(buffer):
+                hash_func.update(view[:size])
 
         return hash_func.hexdigest()
     except FileNotFoundError:
@@ -140,3 +152,30 @@ def compute_file_hash(file_path, algorithm="sha256", raise_exception=True):
         if raise_exception:
             raise
         return "Failed to compute hash"
+
+
+def reflink_copy(src, dst, *, follow_symlinks=True):
+    """Copy file like shutil.copy2, cloning instead of copying its data where the filesystem supports it"""
+    if not stat.S_ISREG(os.stat(src, follow_symlinks=follow_symlinks).st_mode):
+        # Symlinks, FIFOs, devices, ... get shutil's own handling (opening a FIFO would block)
+        return shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+
+    # Open src first, so that a source that can't be read doesn't leave an empty dst behind
+    with open(src, "rb") as source:
+        try:
+            with open(dst, "wb") as destination:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            return shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+    shutil.copystat(src, dst, follow_symlinks=follow_symlinks)
+    return dst
+
+
+def move(src, dst):
+    """Move src to dst with a rename, falling back to a (reflinked) copy across devices"""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst, copy_function=reflink_copy)
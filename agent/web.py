@@ -7,6 +7,7 @@ import sys
 import traceback
 from base64 import b64decode
 from functools import wraps
+from hashlib import sha256
 from typing import TYPE_CHECKING
 
 from flask import Flask, Response, jsonify, request
@@ -82,6 +83,28 @@ log = logging.getLogger("werkzeug")
 log.handlers = []
 
 
+# (sha256 of token, stored hash) pairs that passed pbkdf2 verification
+VERIFIED_ACCESS_TOKENS = set()
+
+
+def verify_access_token(access_token: str, stored_hash: str) -> bool:
+    """
+    Verify access token against the stored pbkdf2 hash
+
+    pbkdf2 is deliberately slow, so tokens that already passed are
+    remembered (by digest) for as long as the stored hash stays the same
+    """
+    key = (sha256(access_token.encode()).digest(), stored_hash)
+    if key in VERIFIED_ACCESS_TOKENS:
+        return True
+    if not pbkdf2.verify(access_token, stored_hash):
+        return False
+    if len(VERIFIED_ACCESS_TOKENS) > 16:
+        VERIFIED_ACCESS_TOKENS.clear()
+    VERIFIED_ACCESS_TOKENS.add(key)
+    return True
+
+
 @application.before_request
 def validate_access_token():
     try:
@@ -89,10 +112,10 @@ def validate_access_token():
             return None
         method, access_token = request.headers["Authorization"].split(" ")
         stored_hash = Server().config["access_token"]
-        if method.lower() == "bearer" and pbkdf2.verify(access_token, stored_hash):
+        if method.lower() == "bearer" and verify_access_token(access_token, stored_hash):
             return None
         access_token = b64decode(access_token).decode().split(":")[1]
-        if method.lower() == "basic" and pbkdf2.verify(access_token, stored_hash):
+        if method.lower() == "basic" and verify_access_token(access_token, stored_hash):
             return None
     except Exception:
         pass